@@ -1,7 +1,18 @@
+import asyncio
+import contextvars
+import csv
+import json
+import os
 import time
-from web3 import Web3
-import pandas as pd
-from datetime import datetime
+from collections import OrderedDict
+import aiohttp
+import eth_abi
+from web3 import AsyncWeb3, AsyncHTTPProvider, Web3, WebSocketProvider
+from web3.exceptions import PersistentConnectionError, ProviderConnectionError, Web3RPCError
+from web3.providers.async_base import AsyncBaseProvider
+from websockets.exceptions import WebSocketException
+from datetime import datetime, timezone
+from fractions import Fraction
 
 # ----------------------------------------------------------
 # 1. CONNECT TO POLYGON NETWORK
@@ -11,9 +22,143 @@ from datetime import datetime
 # It's like the "address" where our bot sends requests
 POLYGON_RPC = "https://polygon-mainnet.g.alchemy.com/v2/t7BD_4UZiRVFBwnkvFbBw"
 
-# Connect to Polygon network using Web3
+# The same Alchemy link, but as a WebSocket: Alchemy pushes every new block to us
+POLYGON_WS = POLYGON_RPC.replace("https://", "wss://", 1)
+
+# Backup public Polygon RPCs, used when Alchemy is slow or down
+RPC_URLS = [
+    POLYGON_RPC,
+    "https://polygon-rpc.com",
+    "https://rpc.ankr.com/polygon",
+    "https://polygon.llamarpc.com",
+]
+
 # The timeout just means: "If we don’t get a response in 10 seconds, stop waiting"
-web3 = Web3(Web3.HTTPProvider(POLYGON_RPC, request_kwargs={"timeout": 10}))
+# We don't retry the same RPC: if it fails we move straight on to the next one
+RPC_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# Only a revert means "your call itself is wrong". Any other error answer
+# (rate limits, bad API key, a node that is behind or broken, ...) is the RPC's
+# fault, so for those we move on to the next RPC.
+RPC_CALL_ERROR_CODE = 3
+RPC_CALL_ERROR_TEXT = "execution reverted"
+
+# For every RPC we remember how fast it answers and how often it works
+# (both are moving averages, so recent requests count the most).
+# A new RPC starts out as "as slow as the timeout" until it proves itself,
+# and every failure counts as a request that took the full timeout.
+EWMA_ALPHA = 0.3        # How much the newest request counts in the averages
+RPC_COOLDOWN = 30       # Seconds we skip an RPC after it fails
+RPC_FAILURE_LATENCY = RPC_TIMEOUT.total
+RPCS = [
+    {
+        "url": url,
+        "provider": AsyncHTTPProvider(
+            url, request_kwargs={"timeout": RPC_TIMEOUT}, exception_retry_configuration=None
+        ),
+        "latency": RPC_FAILURE_LATENCY,
+        "success_rate": 1.0,
+        "down_until": 0.0,
+    }
+    for url in RPC_URLS
+]
+
+# While one price check runs, all of its requests go to ONE RPC (see fetch_prices),
+# so every answer comes from the same node and the same block
+_pinned_rpc = contextvars.ContextVar("pinned_rpc", default=None)
+
+def pick_providers():
+    """
+    Returns all RPCs, best one first.
+    Working RPCs are sorted by speed (slowed down by how often they fail);
+    RPCs that just failed go to the back of the line.
+    If a price check has pinned an RPC, only that one is returned.
+    """
+    pinned = _pinned_rpc.get()
+    if pinned is not None:
+        return [pinned]
+    now = time.monotonic()
+    return sorted(RPCS, key=lambda rpc: (
+        rpc["down_until"] > now,
+        rpc["latency"] / max(rpc["success_rate"], 0.01),
+    ))
+
+def record_rpc_result(rpc, ok, seconds=0.0):
+    """
+    Updates an RPC's speed / success averages after a request.
+    """
+    rpc["success_rate"] = (1 - EWMA_ALPHA) * rpc["success_rate"] + EWMA_ALPHA * (1.0 if ok else 0.0)
+    if not ok:
+        seconds = RPC_FAILURE_LATENCY
+        rpc["down_until"] = time.monotonic() + RPC_COOLDOWN
+    rpc["latency"] = (1 - EWMA_ALPHA) * rpc["latency"] + EWMA_ALPHA * seconds
+
+def is_call_error(error):
+    """
+    True if a JSON-RPC error answer is our call's own fault (it reverted).
+    Every other error is treated as the RPC's fault.
+    """
+    if not isinstance(error, dict):
+        return False
+    message = str(error.get("message", "")).lower()
+    return error.get("code") == RPC_CALL_ERROR_CODE or RPC_CALL_ERROR_TEXT in message
+
+class LoadBalancedProvider(AsyncBaseProvider):
+    """
+    A web3 provider that sends each request to the best RPC in RPCS.
+    If that RPC fails (or answers with any error other than a revert), the same request
+    is sent to the next one.
+    """
+    async def make_request(self, method, params):
+        last_error = None
+        last_response = None
+        for rpc in pick_providers():
+            start = time.monotonic()
+            try:
+                response = await rpc["provider"].make_request(method, params)
+            except Exception as e:
+                record_rpc_result(rpc, False)
+                print(f"[WARN] {rpc['url']} failed: {e}")
+                last_error = e
+                continue
+            if "error" in response and not is_call_error(response["error"]):
+                record_rpc_result(rpc, False)
+                print(f"[WARN] {rpc['url']} answered with an error: {response['error']}")
+                last_response = response
+                continue
+            record_rpc_result(rpc, True, time.monotonic() - start)
+            return response
+        # Every RPC failed: hand back the last error answer (web3 turns it into an exception)
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+    async def is_connected(self, show_traceback=False):
+        for rpc in pick_providers():
+            if await rpc["provider"].is_connected(show_traceback):
+                return True
+        return False
+
+# Connect to Polygon network using Web3
+# We use the async version so we can wait on several requests at the same time
+web3 = AsyncWeb3(LoadBalancedProvider())
+
+# All our requests share ONE HTTP session with a small pool of kept-alive connections.
+# This way we don't redo the connection + TLS handshake on every poll.
+_http_session = None
+
+def get_http_session():
+    """
+    Returns the shared HTTP session (it is made the first time we need it).
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=60),
+            headers={"Connection": "keep-alive"},
+            timeout=RPC_TIMEOUT,
+        )
+    return _http_session
 
 # ----------------------------------------------------------
 # 2. DEX (EXCHANGES) WE WILL CHECK
@@ -35,170 +180,525 @@ DEXES = {
 # ----------------------------------------------------------
 # 3. TOKENS WE ARE TRADING
 # ----------------------------------------------------------
+# Symbol / name / decimals of well-known tokens are stored in token_meta.json,
+# so we never have to ask the blockchain for them.
+# Tokens that are not in the file are looked up once (see get_token_meta) and kept
+# separately in FETCHED_TOKEN_META, so we always know which entries came from the chain.
+TOKEN_META_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "token_meta.json")
+with open(TOKEN_META_FILE) as _f:
+    TOKEN_META = {Web3.to_checksum_address(addr): meta for addr, meta in json.load(_f).items()}
+FETCHED_TOKEN_META = {}
+
 # We will check prices between USDC and WETH
 # USDC = stablecoin (1 USDC ~ $1)
 # WETH = Wrapped Ethereum
-TOKEN0 = {
-    "symbol": "USDC",
-    "address": Web3.to_checksum_address("0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174"),
-    "decimals": 6
-}
-TOKEN1 = {
-    "symbol": "WETH",
-    "address": Web3.to_checksum_address("0x7ceB23fD6bC0adD59E62ac25578270cFf1b9f619"),
-    "decimals": 18
-}
+_usdc = Web3.to_checksum_address("0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174")
+_weth = Web3.to_checksum_address("0x7ceB23fD6bC0adD59E62ac25578270cFf1b9f619")
+TOKEN0 = {"address": _usdc, **TOKEN_META[_usdc]}
+TOKEN1 = {"address": _weth, **TOKEN_META[_weth]}
 
 # ----------------------------------------------------------
 # 4. CONTRACT FUNCTION WE NEED
 # ----------------------------------------------------------
 # We only need one function: getAmountsOut
 # It tells us: "If I give you X USDC, how much WETH will I get?"
-ROUTER_ABI = [
+# A contract finds the function by the first 4 bytes of the hash of its signature (the "selector")
+GET_AMOUNTS_OUT_SELECTOR = Web3.keccak(text="getAmountsOut(uint256,address[])")[:4]
+
+# To look up an unknown token we ask it for its decimals, symbol and name
+# (just like getAmountsOut, we only need each function's selector)
+ERC20_SELECTORS = {
+    "decimals": Web3.keccak(text="decimals()")[:4],
+    "symbol": Web3.keccak(text="symbol()")[:4],
+    "name": Web3.keccak(text="name()")[:4],
+}
+
+# ----------------------------------------------------------
+# 5. TRADING SIMULATION SETTINGS
+# ----------------------------------------------------------
+START_AMOUNT = 100 * (10 ** TOKEN0["decimals"])  # Start with 100 USDC (scaled to blockchain decimals)
+TRADING_PAIR = [TOKEN0["address"], TOKEN1["address"]]  # We go from USDC → WETH
+FEE_RATE = 0.003    # 0.3% DEX fee
+SLIPPAGE = 0.001    # 0.1% price movement allowed
+MIN_PROFIT = 1      # We only care if profit is more than $1
+
+# What's left of our money after a full trade: we pay the fee and lose some
+# to slippage twice (once buying WETH, once selling it back)
+# Kept as an exact fraction so the profit math has no rounding errors
+NET_FACTOR = (1 - Fraction(str(FEE_RATE))) ** 2 * (1 - Fraction(str(SLIPPAGE))) ** 2
+
+# ----------------------------------------------------------
+# 6. MULTICALL3 (ASK ALL DEXES IN ONE REQUEST)
+# ----------------------------------------------------------
+# Multicall3 is a helper contract deployed at the same address on most chains.
+# We hand it a list of (contract, calldata) pairs and it runs them all for us,
+# so we only pay for ONE round-trip to the RPC instead of one per DEX.
+MULTICALL3_ADDR = Web3.to_checksum_address("0xcA11bde05977b3631167028862bE2a173976CA11")
+MULTICALL3_ABI = [
     {
         "inputs": [
-            {"internalType": "uint256", "name": "amountIn", "type": "uint256"},
-            {"internalType": "address[]", "name": "path", "type": "address[]"}
+            {"internalType": "bool", "name": "requireSuccess", "type": "bool"},
+            {
+                "components": [
+                    {"internalType": "address", "name": "target", "type": "address"},
+                    {"internalType": "bytes", "name": "callData", "type": "bytes"}
+                ],
+                "internalType": "struct Multicall3.Call[]",
+                "name": "calls",
+                "type": "tuple[]"
+            }
         ],
-        "name": "getAmountsOut",
+        "name": "tryAggregate",
         "outputs": [
-            {"internalType": "uint256[]", "name": "", "type": "uint256[]"}
+            {
+                "components": [
+                    {"internalType": "bool", "name": "success", "type": "bool"},
+                    {"internalType": "bytes", "name": "returnData", "type": "bytes"}
+                ],
+                "internalType": "struct Multicall3.Result[]",
+                "name": "returnData",
+                "type": "tuple[]"
+            }
         ],
-        "stateMutability": "view",
+        "stateMutability": "payable",
         "type": "function"
     }
 ]
+multicall = web3.eth.contract(address=MULTICALL3_ADDR, abi=MULTICALL3_ABI)
+
+# The question we ask every DEX never changes (same amount, same path),
+# so we encode it into raw bytes once here: selector + arguments.
+GET_AMOUNTS_OUT_CALLDATA = "0x" + bytes(
+    GET_AMOUNTS_OUT_SELECTOR + eth_abi.encode(["uint256", "address[]"], [START_AMOUNT, TRADING_PAIR])
+).hex()
+
+# The list of calls we hand to Multicall3 never changes either, so the whole request is encoded once
+MULTICALL_CALLS = [(data["router"], GET_AMOUNTS_OUT_CALLDATA) for data in DEXES.values()]
+MULTICALL_CALLDATA = multicall.encode_abi("tryAggregate", args=[False, MULTICALL_CALLS])
 
 # ----------------------------------------------------------
-# 5. TRADING SIMULATION SETTINGS
+# FUNCTION: eth_call with a short-lived cache
 # ----------------------------------------------------------
-START_AMOUNT = 100 * (10 ** TOKEN0["decimals"])  # Start with 100 USDC (scaled to blockchain decimals)
-TRADING_PAIR = [TOKEN0["address"], TOKEN1["address"]]  # We go from USDC → WETH
-FEE_RATE = 0.003    # 0.3% DEX fee
-SLIPPAGE = 0.001    # 0.1% price movement allowed
-MIN_PROFIT = 1      # We only care if profit is more than $1
+# The answer to the same call in the same block never changes, so we keep
+# the most recent answers. Old blocks simply fall out as new ones come in.
+# Note: the price loop itself never asks twice (fetch_prices already reuses its
+# whole result within a block); this is for other callers, e.g. future strategies
+# that need the same quotes in the same block.
+CALL_CACHE_SIZE = 1024
+_call_cache = OrderedDict()
+
+async def cached_eth_call(block_hash, to, data):
+    """
+    Like web3.eth.call, but asks about block `block_hash` and remembers the answer,
+    so anyone asking the same question in the same block gets it for free.
+    Without a block hash we just ask about the latest block (nothing is remembered).
+    """
+    if block_hash is None:
+        return await web3.eth.call({"to": to, "data": data})
+
+    key = (block_hash, to, data)
+    if key in _call_cache:
+        _call_cache.move_to_end(key)
+        return _call_cache[key]
+
+    raw = await web3.eth.call({"to": to, "data": data}, block_identifier=block_hash)
+    _call_cache[key] = raw
+    if len(_call_cache) > CALL_CACHE_SIZE:
+        _call_cache.popitem(last=False)  # Forget the oldest answer
+    return raw
 
 # ----------------------------------------------------------
 # FUNCTION: Get price from one DEX
 # ----------------------------------------------------------
-def get_amount_out(router_address, amount_in, path):
+async def get_amount_out(router_address, block_hash=None):
     """
     Talks to a DEX and asks:
-    "If I give you X amount of token A, how much token B will you give me?"
+    "If I give you START_AMOUNT of TOKEN0, how much TOKEN1 will you give me?"
+    The question is already encoded (GET_AMOUNTS_OUT_CALLDATA), so we send it as a
+    raw eth_call and decode the answer with eth_abi ourselves,
+    which skips web3's slower contract-call machinery.
     """
-    print(f"[DEBUG] Asking {router_address} for {amount_in} via {path}")
-    router = web3.eth.contract(address=router_address, abi=ROUTER_ABI)
+    print(f"[DEBUG] Asking {router_address} directly")
     try:
-        amounts = router.functions.getAmountsOut(amount_in, path).call()
+        raw = await cached_eth_call(block_hash, router_address, GET_AMOUNTS_OUT_CALLDATA)
+        (amounts,) = eth_abi.decode(["uint256[]"], raw)
         return amounts[-1]  # Last number is the final amount we’d get
     except Exception as e:
         print(f"[ERROR] Could not get price: {e}")
         return None
 
+# ----------------------------------------------------------
+# FUNCTION: Send many eth_calls in one HTTP request
+# ----------------------------------------------------------
+async def batch_eth_call(calls, block_hash=None):
+    """
+    Sends all (address, calldata) pairs as ONE JSON-RPC batch request,
+    asking about block `block_hash` (or the latest block if we don't have one).
+    Returns a list of (success, return_bytes) in the same order as `calls`,
+    just like Multicall3's tryAggregate does, or None if no RPC could answer.
+    """
+    block = "latest" if block_hash is None else "0x" + bytes(block_hash).hex()
+    payload = [
+        {"jsonrpc": "2.0", "id": i, "method": "eth_call", "params": [{"to": to, "data": data}, block]}
+        for i, (to, data) in enumerate(calls)
+    ]
+    # Like LoadBalancedProvider: try the best RPC first, move on to the next one if it fails
+    replies = None
+    for rpc in pick_providers():
+        start = time.monotonic()
+        try:
+            async with get_http_session().post(rpc["url"], json=payload) as response:
+                response.raise_for_status()
+                answer = await response.json()
+            if not isinstance(answer, list):
+                raise ValueError(f"not a batch answer: {answer}")
+            node_errors = [r["error"] for r in answer if "error" in r and not is_call_error(r["error"])]
+            if node_errors:
+                raise ValueError(node_errors[0])
+        except Exception as e:
+            record_rpc_result(rpc, False)
+            print(f"[WARN] Batch request to {rpc['url']} failed: {e}")
+            continue
+        record_rpc_result(rpc, True, time.monotonic() - start)
+        replies = {r.get("id"): r for r in answer}
+        break
+    if replies is None:
+        return None
+
+    # The node may answer in any order, so match each answer back by its id
+    results = []
+    for i in range(len(calls)):
+        result = replies.get(i, {}).get("result")
+        if result and result != "0x":
+            results.append((True, bytes.fromhex(result[2:])))
+        else:
+            results.append((False, b""))
+    return results
+
+# ----------------------------------------------------------
+# FUNCTION: Get token info (decimals, symbol, name)
+# ----------------------------------------------------------
+def _decode_text(ret):
+    """
+    Decodes a token's symbol() / name() answer.
+    Most tokens return a string, but some older ones (like MKR) return bytes32.
+    """
+    try:
+        (text,) = eth_abi.decode(["string"], ret)
+        return text
+    except Exception:
+        (raw,) = eth_abi.decode(["bytes32"], ret)
+        return raw.rstrip(b"\0").decode("utf-8", errors="replace")
+
+async def get_token_meta(address):
+    """
+    Returns {"symbol", "name", "decimals"} for a token.
+    Known tokens come straight from TOKEN_META (or FETCHED_TOKEN_META if we already
+    looked them up). Unknown ones are asked on-chain with ONE Multicall3 request,
+    and the answer is kept in FETCHED_TOKEN_META.
+    Returns None if the token can't be read.
+    Nothing calls this yet: it is for when the bot trades more than one fixed pair.
+    """
+    address = Web3.to_checksum_address(address)
+    if address in TOKEN_META:
+        return TOKEN_META[address]
+    if address in FETCHED_TOKEN_META:
+        return FETCHED_TOKEN_META[address]
+
+    fields = ["decimals", "symbol", "name"]
+    calls = [(address, "0x" + bytes(ERC20_SELECTORS[field]).hex()) for field in fields]
+    try:
+        data = multicall.encode_abi("tryAggregate", args=[False, calls])
+        raw = await web3.eth.call({"to": MULTICALL3_ADDR, "data": data})
+        (results,) = eth_abi.decode(["(bool,bytes)[]"], raw)
+
+        meta = {}
+        for field, (success, ret) in zip(fields, results):
+            if not success or not ret:
+                print(f"[ERROR] Token {address} has no readable {field}")
+                return None
+            if field == "decimals":
+                (meta[field],) = eth_abi.decode(["uint8"], ret)
+            else:
+                meta[field] = _decode_text(ret)
+    except Exception as e:
+        print(f"[ERROR] Could not get token info for {address}: {e}")
+        return None
+
+    FETCHED_TOKEN_META[address] = meta
+    return meta
+
 # ----------------------------------------------------------
 # FUNCTION: Get prices from all DEXes
 # ----------------------------------------------------------
-def fetch_prices():
+# Prices can only change when a new block is made, so we remember
+# the last block we checked and the prices we got for it
+_last_block_hash = None
+_last_prices = None
+
+async def fetch_prices(block_hash=None):
     """
     Checks price of WETH (in USDC) on each DEX.
+    All DEXes are asked at once through Multicall3 (one RPC request).
+    If Multicall3 is not usable, a JSON-RPC batch (also one request) is used.
+    If we are still on the same block as last time, the old prices are reused.
+    `block_hash` is the hash of the newest block, if we already know it (we look it up otherwise).
+    The whole check runs on ONE RPC; if that RPC fails we start over on the next one.
     """
+    for rpc in pick_providers():
+        token = _pinned_rpc.set(rpc)
+        try:
+            return await _fetch_prices_at(block_hash)
+        except Exception as e:
+            # Count it against this RPC, so the next check doesn't pin it again
+            record_rpc_result(rpc, False)
+            print(f"[WARN] Price check on {rpc['url']} failed, trying the next RPC: {e}")
+        finally:
+            _pinned_rpc.reset(token)
+
+    print("[ERROR] Could not get prices from any RPC")
+    return {dex: None for dex in DEXES}
+
+async def _fetch_prices_at(block_hash):
+    """
+    Does the work of fetch_prices() on the currently pinned RPC.
+    Raises if that RPC can't give us the block or the quotes.
+    """
+    global _last_block_hash, _last_prices
+    if block_hash is None:
+        block_hash = (await web3.eth.get_block("latest"))["hash"]
+    if block_hash == _last_block_hash:
+        return _last_prices
+
+    try:
+        raw = await cached_eth_call(block_hash, MULTICALL3_ADDR, MULTICALL_CALLDATA)
+        (results,) = eth_abi.decode(["(bool,bytes)[]"], raw)
+    except Exception as e:
+        print(f"[ERROR] Multicall failed, sending a batch request instead: {e}")
+        results = await batch_eth_call(MULTICALL_CALLS, block_hash)
+        if results is None:
+            raise RuntimeError("batch request failed too")
+
+    outs = {}
+    missing = []
+    for dex, (success, ret) in zip(DEXES, results):
+        # "success" with empty or broken data happens too (e.g. the router has no code),
+        # so a DEX only counts as answered if its data really decodes
+        out_weth = None
+        if success:
+            try:
+                (amounts,) = eth_abi.decode(["uint256[]"], ret)
+                out_weth = amounts[-1]
+            except Exception as e:
+                print(f"[ERROR] Bad answer from {dex}: {e}")
+        if out_weth is None:
+            missing.append(dex)
+        else:
+            outs[dex] = out_weth
+
+    # DEXes that failed inside the multicall are asked directly, all at the same time
+    answers = await asyncio.gather(
+        *[get_amount_out(DEXES[dex]["router"], block_hash) for dex in missing],
+        return_exceptions=True,
+    )
+    for dex, out_weth in zip(missing, answers):
+        outs[dex] = None if isinstance(out_weth, BaseException) else out_weth
+
     prices = {}
-    for dex, data in DEXES.items():
-        out_weth = get_amount_out(data["router"], START_AMOUNT, TRADING_PAIR)
+    for dex in DEXES:
+        out_weth = outs[dex]
         if out_weth:
             # Convert to USDC price per WETH
-            price = (START_AMOUNT / out_weth) * (10 ** (TOKEN1["decimals"] - TOKEN0["decimals"]))
+            # (an exact fraction of the on-chain integers, so no precision is lost)
+            price = Fraction(START_AMOUNT, out_weth) * (10 ** (TOKEN1["decimals"] - TOKEN0["decimals"]))
             prices[dex] = price
         else:
             prices[dex] = None
+
+    # Only remember this block if we actually read something, so a failed
+    # round gets tried again instead of giving back empty prices
+    if any(price is not None for price in prices.values()):
+        _last_block_hash, _last_prices = block_hash, prices
     return prices
 
 # ----------------------------------------------------------
 # FUNCTION: Find arbitrage opportunities
 # ----------------------------------------------------------
-def find_arbitrage(prices):
+def find_arbitrage(prices, now_iso):
     """
     Finds where we can buy cheap on one DEX and sell high on another.
-    Returns a list of trades that give profit.
+    The best trade is always: buy on the cheapest DEX, sell on the most expensive one,
+    so we only need to check that one pair.
+    Returns a list with that trade if it gives profit (or an empty list).
+    `now_iso` is the time of this check, stamped on every trade we find.
     """
     opps = []
-    dexes = list(prices.keys())
+    valid = {dex: price for dex, price in prices.items() if price is not None}
+    if len(valid) < 2:
+        return opps
 
-    for i in range(len(dexes)):
-        for j in range(len(dexes)):
-            if i == j or prices[dexes[i]] is None or prices[dexes[j]] is None:
-                continue
+    buy_dex, buy_price = min(valid.items(), key=lambda item: item[1])
+    sell_dex, sell_price = max(valid.items(), key=lambda item: item[1])
+
+    # If buying price is cheaper than selling price → possible profit
+    if buy_price < sell_price:
+        usdc_start = START_AMOUNT
 
-            buy_dex = dexes[i]
-            sell_dex = dexes[j]
-            buy_price = prices[buy_dex]
-            sell_price = prices[sell_dex]
-
-            # If buying price is cheaper than selling price → possible profit
-            if buy_price < sell_price:
-                usdc_start = START_AMOUNT
-
-                # Step 1: Buy WETH
-                amount_weth = (usdc_start * (1 - FEE_RATE)) / buy_price
-                amount_weth *= (1 - SLIPPAGE)
-
-                # Step 2: Sell WETH
-                usdc_final = amount_weth * sell_price * (1 - FEE_RATE)
-                usdc_final *= (1 - SLIPPAGE)
-
-                profit = usdc_final - usdc_start
-
-                # Only store if profit > $1
-                if profit > MIN_PROFIT:
-                    opps.append({
-                        "timestamp": datetime.utcnow().isoformat(),
-                        "buy_on": buy_dex,
-                        "sell_on": sell_dex,
-                        "buy_price": buy_price,
-                        "sell_price": sell_price,
-                        "profit": profit / (10 ** TOKEN0["decimals"]),
-                    })
+        # Buy WETH cheap, sell it expensive, minus fees and slippage on both trades
+        ratio = sell_price / buy_price
+        profit = usdc_start * (NET_FACTOR * ratio - 1)
+
+        # Only store if profit > $1
+        if profit > MIN_PROFIT:
+            opps.append({
+                "timestamp": now_iso,
+                "buy_on": buy_dex,
+                "sell_on": sell_dex,
+                # Only here, for the log, do we turn the exact numbers into normal floats
+                "buy_price": float(buy_price),
+                "sell_price": float(sell_price),
+                "profit": float(profit / (10 ** TOKEN0["decimals"])),
+            })
     return opps
 
 # ----------------------------------------------------------
 # DATA STORAGE FOR LOGGING
 # ----------------------------------------------------------
-df_log = pd.DataFrame(columns=["timestamp", "buy_on", "sell_on", "buy_price", "sell_price", "profit"])
+# Every opportunity becomes one new line at the end of this CSV file
+LOG_FILE = "arbitrage_log.csv"
+LOG_FIELDS = ["timestamp", "buy_on", "sell_on", "buy_price", "sell_price", "profit"]
+
+# ----------------------------------------------------------
+# FUNCTION: Wait for new blocks
+# ----------------------------------------------------------
+# Errors that mean the WebSocket / subscription itself broke (we reconnect on these)
+WS_ERRORS = (
+    ProviderConnectionError, PersistentConnectionError, Web3RPCError,
+    WebSocketException, OSError, asyncio.TimeoutError,
+)
+WS_MAX_BACKOFF = 60     # Longest wait (seconds) between reconnect attempts
+
+async def new_blocks(min_interval_seconds):
+    """
+    Listens to Polygon over a WebSocket and gives back the newest block's hash.
+    Blocks that arrive while a check is still running are collapsed: we only give back
+    the latest one, since older blocks' prices are already out of date.
+    We also never give back two hashes less than `min_interval_seconds` apart.
+    """
+    # Try to connect only once: main_loop does its own retrying and keeps polling
+    # in between, instead of web3 blocking here for ~20s over 5 attempts
+    async with AsyncWeb3(WebSocketProvider(POLYGON_WS, max_connection_retries=1)) as w3ws:
+        await w3ws.eth.subscribe("newHeads")
+
+        # Read heads in the background and only remember the newest one
+        latest = {"hash": None}
+        arrived = asyncio.Event()
+
+        async def read_heads():
+            async for message in w3ws.socket.process_subscriptions():
+                latest["hash"] = message["result"]["hash"]
+                arrived.set()
+
+        reader = asyncio.create_task(read_heads())
+        try:
+            last_check = 0.0
+            while True:
+                # Wait for a new head, or for the reader to stop
+                waiter = asyncio.create_task(arrived.wait())
+                await asyncio.wait({waiter, reader}, return_when=asyncio.FIRST_COMPLETED)
+                if not arrived.is_set():
+                    waiter.cancel()
+                    reader.result()  # raises the reader's error, if it had one
+                    return
+                wait = last_check + min_interval_seconds - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                arrived.clear()
+                last_check = time.monotonic()
+                yield latest["hash"]
+        finally:
+            reader.cancel()
 
 # ----------------------------------------------------------
 # MAIN LOOP
 # ----------------------------------------------------------
-def main_loop(interval_seconds=20):
+async def check_once(writer, log_file, block_hash=None):
     """
-    Runs forever: check prices → find arbitrage → log profit opportunities.
+    One round: check prices → find arbitrage → log profit opportunities.
     """
-    global df_log
-    print("--- Polygon Arbitrage Detector Bot Started ---")
+    prices = await fetch_prices(block_hash)
+    shown = {dex: None if price is None else round(float(price), 4) for dex, price in prices.items()}
+    print(f"[INFO] Current Prices: {shown}")
 
-    while True:
-        prices = fetch_prices()
-        print(f"[INFO] Current Prices: {prices}")
+    # One timestamp per check: every trade found in it happened at the same time
+    now_iso = datetime.now(timezone.utc).isoformat()
+    opportunities = find_arbitrage(prices, now_iso)
 
-        opportunities = find_arbitrage(prices)
+    if opportunities:
+        for opp in opportunities:
+            print(f"[ARBITRAGE] Buy on {opp['buy_on']} at {opp['buy_price']:.4f}, "
+                  f"Sell on {opp['sell_on']} at {opp['sell_price']:.4f} → "
+                  f"Profit: ${opp['profit']:.2f}")
+            writer.writerow(opp)
+        log_file.flush()
 
-        if opportunities:
-            for opp in opportunities:
-                print(f"[ARBITRAGE] Buy on {opp['buy_on']} at {opp['buy_price']:.4f}, "
-                      f"Sell on {opp['sell_on']} at {opp['sell_price']:.4f} → "
-                      f"Profit: ${opp['profit']:.2f}")
+async def safe_check(writer, log_file, block_hash=None):
+    """
+    Runs check_once(), but a failed check only gets printed; the bot keeps going.
+    """
+    try:
+        await check_once(writer, log_file, block_hash)
+    except Exception as e:
+        print(f"[ERROR] Price check failed: {e}")
 
-            df_log = pd.concat([df_log, pd.DataFrame(opportunities)], ignore_index=True)
-            df_log.to_csv("arbitrage_log.csv", index=False)
+async def main_loop(interval_seconds=20, min_interval_seconds=1):
+    """
+    Runs forever, checking the newest block each time new blocks arrive.
+    If the WebSocket stops working, we check every `interval_seconds` instead
+    while we keep trying to reconnect (waiting longer after each failed try).
+    """
+    print("--- Polygon Arbitrage Detector Bot Started ---")
 
-        time.sleep(interval_seconds)
+    # Open the log once and keep adding to it (write the header only for a new file)
+    with open(LOG_FILE, "a", newline="") as log_file:
+        writer = csv.DictWriter(log_file, fieldnames=LOG_FIELDS)
+        if log_file.tell() == 0:
+            writer.writeheader()
+
+        backoff = 1
+        while True:
+            try:
+                async for block_hash in new_blocks(min_interval_seconds):
+                    backoff = 1
+                    await safe_check(writer, log_file, block_hash)
+                print("[WARN] Block subscription ended")
+            except WS_ERRORS as e:
+                print(f"[ERROR] Block subscription failed: {e}")
+
+            # Until we reconnect, keep checking on a timer so no blocks are missed
+            print(f"[INFO] Polling every {interval_seconds}s, reconnecting in {backoff}s")
+            reconnect_at = time.monotonic() + backoff
+            while time.monotonic() < reconnect_at:
+                await safe_check(writer, log_file)
+                await asyncio.sleep(min(interval_seconds, max(0.0, reconnect_at - time.monotonic())))
+            backoff = min(backoff * 2, WS_MAX_BACKOFF)
 
 # ----------------------------------------------------------
 # START PROGRAM
 # ----------------------------------------------------------
-if __name__ == "__main__":
+async def main():
     print("Starting Web3 connection...")
-    if web3.is_connected():
-        print("✅ Connected to Polygon!")
-        main_loop(interval_seconds=6)
-    else:
-        print("❌ Could not connect. Check your RPC URL.")
+    # Make web3 use our shared keep-alive session too
+    for rpc in RPCS:
+        await rpc["provider"].cache_async_session(get_http_session())
+    try:
+        if await web3.is_connected():
+            print("✅ Connected to Polygon!")
+            await main_loop(interval_seconds=6)
+        else:
+            print("❌ Could not connect. Check your RPC URL.")
+    finally:
+        await _http_session.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())